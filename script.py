@@ -1,9 +1,27 @@
 import os
-import base64
+import asyncio
 import json
 import datetime
 import sys
+import aiohttp
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from tsdownsample import MinMaxLTTBDownsampler
+from urllib3.util.retry import Retry
+
+
+# Shared session so repeated GitHub API requests reuse keep-alive connections
+_session = requests.Session()
+_session.mount(
+    "https://api.github.com",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    ),
+)
 
 
 def get_repo_info():
@@ -14,108 +32,261 @@ def get_repo_info():
     return owner, name
 
 
-def get_file(owner, repo, path, ref, token):
+# Local copies of state files, valid as long as their git blob SHA matches
+STATE_CACHE_DIR = ".state_cache"
+
+
+def _read_cached_file(path, blob_sha):
+    """Return the cached content of ``path`` if it is blob ``blob_sha``, else ``None``."""
+    cache_path = os.path.join(STATE_CACHE_DIR, path)
+    try:
+        with open(cache_path + ".meta") as f:
+            meta = json.load(f)
+        if meta.get("sha") != blob_sha:
+            return None
+        with open(cache_path, "rb") as f:
+            return f.read()
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_file(path, content, blob_sha):
+    cache_path = os.path.join(STATE_CACHE_DIR, path)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, "wb") as f:
+        f.write(content)
+    with open(cache_path + ".meta", "w") as f:
+        json.dump({"sha": blob_sha}, f)
+
+
+def get_file(owner, repo, path, ref, blob_sha=None):
+    """Return the raw content of a file as bytes.
+
+    When the file's ``blob_sha`` at ``ref`` is given and matches the locally
+    cached copy, that copy is returned without downloading the file.
+
+    Raises :class:`FileNotFoundError` if ``path`` does not exist at ``ref``
+    and :class:`RuntimeError` for any other failure.
+    """
+    if blob_sha:
+        cached = _read_cached_file(path, blob_sha)
+        if cached is not None:
+            return cached
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-    headers = {"Authorization": f"token {token}", "Accept": "application/vnd.github.v3+json"}
     params = {"ref": ref}
-    resp = requests.get(url, headers=headers, params=params)
+    # The raw media type returns the file itself rather than base64 in JSON
+    headers = {"Accept": "application/vnd.github.raw"}
+    resp = _session.get(url, params=params, headers=headers)
+    if resp.status_code == 404:
+        raise FileNotFoundError(f"{path} not found at {ref}")
     if resp.status_code != 200:
         raise RuntimeError(f"Failed to get file: {resp.status_code} {resp.text}")
-    data = resp.json()
-    content = base64.b64decode(data["content"]).decode()
-    sha = data["sha"]
-    return content, sha
+    content = resp.content
+    if blob_sha:
+        _write_cached_file(path, content, blob_sha)
+    return content
 
 
-def update_file(owner, repo, path, new_content, sha, branch, token):
-    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-    headers = {"Authorization": f"token {token}", "Accept": "application/vnd.github.v3+json"}
-    payload = {
-        "message": f"Update {path} via GitHub Action",
-        "content": base64.b64encode(new_content.encode()).decode(),
-        "sha": sha,
-        "branch": branch,
-    }
-    resp = requests.put(url, headers=headers, data=json.dumps(payload))
+def _check(resp, what):
     if resp.status_code not in (200, 201):
-        raise RuntimeError(f"Failed to update file: {resp.status_code} {resp.text}")
-    print(f"Successfully updated {path} on branch {branch}")
+        raise RuntimeError(f"Failed to {what}: {resp.status_code} {resp.text}")
+    return resp.json()
 
-def plot_lag(data: list, fqrn: str) -> None:
-    """Plot synchronization lag from the state data for a specific FQRN.
 
-    ``data`` should be a list of dictionaries with timestamp and fqrns data.
-    The function saves the plot as ``lag_plot_{fqrn}.png``.
+def get_branch_head(owner, repo, branch):
+    """Return ``(commit_sha, tree_sha, {path: blob_sha})`` for the head of ``branch``.
+
+    The blob SHAs cover the files at the top level of the tree.
     """
-    import matplotlib
-    matplotlib.use('Agg')  # non‑interactive backend suitable for CI/headless
-    import matplotlib.pyplot as plt
-    plt.xkcd()
-    plt.rcParams.update({'font.family': 'DejaVu Sans'})
-
-    # Collect data for each host
-    host_data = {}
-    
+    base_url = f"https://api.github.com/repos/{owner}/{repo}/git"
+    ref = _check(_session.get(f"{base_url}/ref/heads/{branch}"), "get branch")
+    commit_sha = ref["object"]["sha"]
+    commit = _check(_session.get(f"{base_url}/commits/{commit_sha}"), "get commit")
+    tree_sha = commit["tree"]["sha"]
+    tree = _check(_session.get(f"{base_url}/trees/{tree_sha}"), "get tree")
+    blobs = {entry["path"]: entry["sha"] for entry in tree["tree"] if entry["type"] == "blob"}
+    return commit_sha, tree_sha, blobs
+
+
+def commit_files(owner, repo, files, branch, head, new_paths=()):
+    """Commit ``files``, a ``{path: content}`` mapping, to ``branch``.
+
+    A ``None`` content deletes the file. ``head`` is the branch head as
+    returned by :func:`get_branch_head` when the current contents were read;
+    the new commit is built on it and the branch is only moved if it still
+    points there, so a concurrent update makes this fail rather than being
+    overwritten. Paths in ``new_paths`` must not exist in ``head`` yet.
+    """
+    parent_sha, parent_tree_sha, parent_blobs = head
+    existing = [path for path in new_paths if path in parent_blobs]
+    if existing:
+        raise RuntimeError(f"Refusing to replace existing {', '.join(existing)} with a new file")
+
+    base_url = f"https://api.github.com/repos/{owner}/{repo}/git"
+    tree_entries = [
+        {"path": path, "mode": "100644", "type": "blob", "sha": None}
+        if content is None else
+        {"path": path, "mode": "100644", "type": "blob", "content": content.decode()}
+        for path, content in files.items()
+    ]
+    tree = _check(
+        _session.post(f"{base_url}/trees", data=json.dumps({
+            "base_tree": parent_tree_sha,
+            "tree": tree_entries,
+        })),
+        "create tree",
+    )
+    new_blobs = {entry["path"]: entry["sha"] for entry in tree["tree"]}
+    commit = _check(
+        _session.post(f"{base_url}/commits", data=json.dumps({
+            "message": f"Update {', '.join(files)} via GitHub Action",
+            "tree": tree["sha"],
+            "parents": [parent_sha],
+        })),
+        "create commit",
+    )
+    # Not forced, so this fails unless the branch still points at the parent
+    _check(
+        _session.patch(f"{base_url}/refs/heads/{branch}", data=json.dumps({"sha": commit["sha"]})),
+        "update branch",
+    )
+    # Cache what was written so the next run does not download it again
+    for path, content in files.items():
+        if content is not None and path in new_blobs:
+            _write_cached_file(path, content, new_blobs[path])
+    print(f"Successfully updated {', '.join(files)} on branch {branch}")
+
+
+# Mirrors failing this many runs in a row are skipped for the cool-off period,
+# which must be longer than the 6 hour interval of the scheduled workflow
+MIRROR_FAILURE_THRESHOLD = 3
+MIRROR_COOLOFF_SECONDS = 24 * 3600
+
+# Series longer than this are downsampled before plotting
+MAX_PLOT_POINTS = 2000
+
+_plt = None
+
+
+def _ensure_mpl():
+    """Import matplotlib on first use and return ``pyplot``."""
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use('Agg')  # non‑interactive backend suitable for CI/headless
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+
+def index_by_fqrn(data: list) -> dict:
+    """Build the lag series of every FQRN and host in a single pass over ``data``.
+
+    Returns a ``{fqrn: {host: (timestamps, lags)}}`` mapping of NumPy arrays,
+    with timestamps in UNIX seconds and lags in hours. Entries whose fetched
+    timestamp is not a valid integer are skipped.
+    """
+    index = {}
     for entry in data:
         if not entry or 'timestamp' not in entry or 'fqrns' not in entry:
             continue
-        
-        # Skip entries that don't have data for this FQRN
-        if fqrn not in entry['fqrns']:
-            continue
-            
         cur_ts = int(entry['timestamp'])
-        current_time = datetime.datetime.utcfromtimestamp(cur_ts)
-        
-        for host, fetched_ts_str in entry['fqrns'][fqrn].items():
-            if host not in host_data:
-                host_data[host] = {'timestamps': [], 'lags': []}
-            
-            try:
-                fetched_ts = int(fetched_ts_str)
-                lag_hours = (fetched_ts - cur_ts) / 3600
-                host_data[host]['timestamps'].append(current_time)
-                host_data[host]['lags'].append(lag_hours)
-            except (ValueError, TypeError):
-                continue
-
-    if host_data:
-        plt.figure(figsize=(12, 6))
-        ax = plt.gca()
-        
-        for host, data_dict in host_data.items():
-            if data_dict['timestamps']:
-                ax.plot(data_dict['timestamps'], data_dict['lags'], 
-                       marker='o', label=host, alpha=0.7)
-        
-        ax.set_title(f'CVMFS Synchronization Lag by Host - {fqrn}')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Synchronization lag (hours)')
-        ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
-        from matplotlib.dates import DateFormatter
-        ax.xaxis.set_major_formatter(DateFormatter('%b %d'))
-        ax.grid(True)
-        plt.tight_layout()
-        plt.savefig(f'lag_plot_{fqrn}.png', bbox_inches='tight')
-        plt.show()
-    else:
+        for fqrn, host_map in entry['fqrns'].items():
+            fqrn_index = index.get(fqrn)
+            if fqrn_index is None:
+                fqrn_index = index[fqrn] = {}
+            for host, fetched_ts_str in host_map.items():
+                try:
+                    fetched_ts = int(fetched_ts_str)
+                except (ValueError, TypeError):
+                    continue
+                series = fqrn_index.get(host)
+                if series is None:
+                    series = fqrn_index[host] = ([], [])
+                series[0].append(cur_ts)
+                series[1].append(fetched_ts)
+
+    for fqrn_index in index.values():
+        for host, (cur_list, fetched_list) in fqrn_index.items():
+            cur = np.array(cur_list, dtype=np.int64)
+            fetched = np.array(fetched_list, dtype=np.int64)
+            fqrn_index[host] = (cur, (fetched - cur) / 3600.0)
+    return index
+
+
+def plot_lag(host_series: dict, fqrn: str, ax) -> None:
+    """Plot synchronization lag from the state data for a specific FQRN.
+
+    ``host_series`` should be the ``{host: (timestamps, lags)}`` mapping for
+    this FQRN as returned by :func:`index_by_fqrn`. The plot is drawn on the
+    matplotlib axes ``ax``.
+    """
+    from matplotlib.dates import DateFormatter
+
+    ax.set_title(f'CVMFS Synchronization Lag by Host - {fqrn}')
+    if not host_series:
         print(f'No valid timestamp pairs found for plotting {fqrn}.')
+        return
 
+    for host, (cur, lags) in host_series.items():
+        if len(cur) > MAX_PLOT_POINTS:
+            # Keep a visually equivalent subset of the long series
+            idx = MinMaxLTTBDownsampler().downsample(cur, lags, n_out=MAX_PLOT_POINTS)
+            cur, lags = cur[idx], lags[idx]
+        # datetime64 avoids matplotlib's per-element datetime conversion
+        ax.plot(cur.astype('datetime64[s]'), lags,
+                marker='o', label=host, alpha=0.7)
 
-def fetch_cvmfs_timestamp(host_url):
-    """Fetch the .cvmfspublished file and return the UNIX timestamp following the leading 'T'."""
-    resp = requests.get(host_url, timeout=10)
-    if resp.status_code != 200:
-        raise RuntimeError(f"Failed to fetch cvmfs timestamp from {host_url}: {resp.status_code}")
-    for line in resp.text.splitlines():
-        if line.startswith('T'):
-            # line format: T<unix_timestamp>
-            return line[1:].strip()
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Synchronization lag (hours)')
+    ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax.xaxis.set_major_formatter(DateFormatter('%b %d'))
+    ax.grid(True)
+
+
+async def fetch_cvmfs_timestamp(session, host_url, byte_range=True):
+    """Fetch the .cvmfspublished file and return the UNIX timestamp following the leading 'T'.
+
+    Only the text header of the manifest is needed, so by default just its
+    first kilobyte is requested and reading stops at the 'T' line.
+    """
+    headers = {"Range": "bytes=0-1023"} if byte_range else None
+    # A short connect timeout so an unreachable mirror fails fast
+    timeout = aiohttp.ClientTimeout(total=10, sock_connect=2)
+    async with session.get(host_url, headers=headers, timeout=timeout) as resp:
+        if resp.status == 416 and byte_range:
+            return await fetch_cvmfs_timestamp(session, host_url, byte_range=False)
+        if resp.status not in (200, 206):
+            raise RuntimeError(f"Failed to fetch cvmfs timestamp from {host_url}: {resp.status}")
+        async for raw_line in resp.content:
+            line = raw_line.decode("ascii", errors="replace").strip()
+            if line == "--":
+                # end of the text header, signature follows
+                break
+            if line.startswith('T'):
+                # line format: T<unix_timestamp>
+                return line[1:].strip()
     raise RuntimeError(f"No line starting with 'T' found in .cvmfspublished from {host_url}")
 
 
-def fetch_all_cvmfs_timestamps(fqrn):
-    """Fetch timestamps from all CVMFS hosts for a given FQRN."""
+def mirror_is_cooling_off(health, host_name, now):
+    """Whether ``host_name`` failed repeatedly and recently enough to be skipped."""
+    record = health.get(host_name)
+    if not record or record["failures"] < MIRROR_FAILURE_THRESHOLD:
+        return False
+    return now - record["last_failure"] < MIRROR_COOLOFF_SECONDS
+
+
+async def fetch_all_cvmfs_timestamps(fqrns, health):
+    """Fetch timestamps from all CVMFS hosts for the given FQRNs concurrently.
+
+    ``health`` maps host names to their recent failure record; mirrors that
+    keep failing are skipped for a cool-off period and ``health`` is updated
+    in place with the outcome of this run. If no mirror answers at all, the
+    problem is assumed to be on our side and ``health`` is left unchanged.
+
+    Returns a ``{fqrn: {host: timestamp}}`` mapping; hosts that failed are omitted.
+    """
     host_bases = [
         "http://s1ral-cvmfs.openhtc.io/cvmfs",
         "http://s1nikhef-cvmfs.openhtc.io/cvmfs",
@@ -125,19 +296,58 @@ def fetch_all_cvmfs_timestamps(fqrn):
         "http://s1ihep-cvmfs.openhtc.io/cvmfs",
         "http://cvmfs-stratum-one.ihep.ac.cn:8000/cvmfs"
     ]
-    
-    results = {}
-    for host_base in host_bases:
-        host_url = f"{host_base}/{fqrn}/.cvmfspublished"
-        try:
-            timestamp = fetch_cvmfs_timestamp(host_url)
-            # Extract host identifier from URL
-            host_name = host_base.split("://")[1].split(":")[0]
-            results[host_name] = timestamp
-        except Exception as e:
-            print(f"Warning: Failed to fetch from {host_url}: {e}")
+
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    # Extract host identifier from URL
+    all_hosts = {host_base.split("://")[1].split(":")[0]: host_base for host_base in host_bases}
+    hosts = {
+        host_name: host_base
+        for host_name, host_base in all_hosts.items()
+        if not mirror_is_cooling_off(health, host_name, now)
+    }
+    if hosts:
+        for host_name in all_hosts.keys() - hosts.keys():
+            print(f"Skipping {host_name}: failed {health[host_name]['failures']} times in a row")
+    else:
+        # Never skip every mirror at once
+        hosts = all_hosts
+
+    requests_to_make = [
+        (fqrn, host_name, f"{host_base}/{fqrn}/.cvmfspublished")
+        for fqrn in fqrns
+        for host_name, host_base in hosts.items()
+    ]
+
+    # Keep-alive connections and cached DNS lookups shared by all requests
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, use_dns_cache=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [fetch_cvmfs_timestamp(session, host_url) for _, _, host_url in requests_to_make]
+        timestamps = await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = {fqrn: {} for fqrn in fqrns}
+    responsive_hosts = set()
+    for (fqrn, host_name, host_url), timestamp in zip(requests_to_make, timestamps):
+        if isinstance(timestamp, Exception):
+            print(f"Warning: Failed to fetch from {host_url}: {timestamp}")
             # Continue with other hosts
-    
+            continue
+        results[fqrn][host_name] = timestamp
+        responsive_hosts.add(host_name)
+
+    if not responsive_hosts:
+        # Most likely the runner has no network, which says nothing about
+        # the mirrors
+        return results
+
+    # A mirror counts as failed only if it did not answer for any FQRN
+    for host_name in hosts:
+        if host_name in responsive_hosts:
+            health.pop(host_name, None)
+        else:
+            record = health.setdefault(host_name, {"failures": 0})
+            record["failures"] += 1
+            record["last_failure"] = now
+
     return results
 
 
@@ -148,66 +358,102 @@ def main():
     token = os.getenv("GITHUB_TOKEN")
     if not token:
         raise RuntimeError("GITHUB_TOKEN not set")
+    _session.headers.update({
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github.v3+json",
+    })
 
-    file_path = "state.json"
+    file_path = "state.jsonl"
+    legacy_file_path = "state.json"
+    health_path = "mirror_health.json"
     branch = "state"
     fqrns = ["singularity", "eic"]
 
-    # Try to read current JSON content
+    # Pin the branch head so every read and the final commit refer to the
+    # same state of the branch
+    head = get_branch_head(owner, repo, branch)
+    head_sha, _, blobs = head
+
+    # Try to read current JSON Lines content, one entry per line. Only a
+    # missing file starts a new history, any other error aborts the run so
+    # the existing history is never overwritten.
+    files_to_commit = {}
+    new_paths = []
     try:
-        content, sha = get_file(owner, repo, file_path, branch, token)
-        data = json.loads(content)
+        content = get_file(owner, repo, file_path, head_sha, blobs.get(file_path))
         print(f"Current content of {file_path} loaded successfully")
-    except Exception as e:
+    except FileNotFoundError as e:
         print(f"Could not load {file_path}: {e}")
-        data = []
-        sha = None  # Will be a new file
+        content = b""  # Will be a new file
+        new_paths.append(file_path)
+        # Carry over the history kept in the old single JSON document format,
+        # removing the old file in the same commit
+        try:
+            legacy_content = get_file(owner, repo, legacy_file_path, head_sha)
+            content = b"".join(orjson.dumps(entry) + b"\n" for entry in orjson.loads(legacy_content))
+            print(f"Migrating history from {legacy_file_path}")
+        except FileNotFoundError as e:
+            print(f"Could not load {legacy_file_path}: {e}")
+        else:
+            files_to_commit[legacy_file_path] = None
+
+    # Failure history of the CVMFS mirrors from previous runs
+    try:
+        health_content = get_file(owner, repo, health_path, head_sha, blobs.get(health_path))
+        health = orjson.loads(health_content)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Could not load {health_path}: {e}")
+        health_content = b""
+        health = {}
 
     # Fetch timestamps from all CVMFS hosts for each FQRN
     fqrn_data = {}
-    for fqrn in fqrns:
-        host_timestamps = fetch_all_cvmfs_timestamps(fqrn)
+    all_timestamps = asyncio.run(fetch_all_cvmfs_timestamps(fqrns, health))
+    for fqrn, host_timestamps in all_timestamps.items():
         if host_timestamps:
             fqrn_data[fqrn] = host_timestamps
         else:
             print(f"Warning: Failed to fetch timestamps for FQRN {fqrn}")
-    
+
+    # Mirror health is only written when it changed
+    new_health_content = orjson.dumps(health, option=orjson.OPT_SORT_KEYS)
+    if new_health_content != health_content:
+        files_to_commit[health_path] = new_health_content
+
     if not fqrn_data:
+        # No mirror answered, which leaves the mirror health unchanged too
         raise RuntimeError("Failed to fetch timestamps from any FQRN")
     
     # Create new entry with current timestamp and all FQRN data
-    current_timestamp = str(int(datetime.datetime.utcnow().timestamp()))
+    current_timestamp = str(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
     new_entry = {
         "timestamp": current_timestamp,
         "fqrns": fqrn_data
     }
     
-    # Append new entry to data
-    data.append(new_entry)
+    # Append new entry as a line, the existing history is left untouched
+    if content and not content.endswith(b"\n"):
+        content += b"\n"
+    new_content = content + orjson.dumps(new_entry) + b"\n"
     
-    # Convert back to JSON string
-    new_content = json.dumps(data, indent=2)
-    
-    # Update the file
-    if sha:
-        update_file(owner, repo, file_path, new_content, sha, branch, token)
-    else:
-        # Create new file (no SHA needed for new files)
-        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{file_path}"
-        headers = {"Authorization": f"token {token}", "Accept": "application/vnd.github.v3+json"}
-        payload = {
-            "message": f"Create {file_path} via GitHub Action",
-            "content": base64.b64encode(new_content.encode()).decode(),
-            "branch": branch,
-        }
-        resp = requests.put(url, headers=headers, data=json.dumps(payload))
-        if resp.status_code not in (200, 201):
-            raise RuntimeError(f"Failed to create file: {resp.status_code} {resp.text}")
-        print(f"Successfully created {file_path} on branch {branch}")
+    # Update the files in a single commit
+    files_to_commit[file_path] = new_content
+    commit_files(owner, repo, files_to_commit, branch, head, new_paths)
 
     # Visualization: plot synchronization lag over time for each FQRN
-    for fqrn in fqrns:
-        plot_lag(data, fqrn)
+    data = [orjson.loads(line) for line in new_content.splitlines() if line]
+    by_fqrn = index_by_fqrn(data)
+    plt = _ensure_mpl()
+    # The xkcd style is scoped to this figure rather than set globally
+    with plt.xkcd():
+        plt.rcParams.update({'font.family': 'DejaVu Sans'})
+        fig, axes = plt.subplots(len(fqrns), 1, figsize=(12, 4 * len(fqrns)),
+                                 sharex=True, squeeze=False)
+        for ax, fqrn in zip(axes[:, 0], fqrns):
+            plot_lag(by_fqrn.get(fqrn, {}), fqrn, ax)
+        fig.tight_layout()
+        fig.savefig('lag_plot.png', bbox_inches='tight')
+    plt.close(fig)
 
 if __name__ == "__main__":
     main()